@@ -17,7 +17,7 @@ The message is forwarded to the other client, without modification,
  S->C: {"method": "NOTIFY", "data": {"type": "offer", "sdp": ...}}
 
 If the other client is not already connected, the data is queued and delivered on subsequent
-connection.
+connection. At most 256 messages are queued, after which the sending client is disconnected.
 
 Additionally, a client may request configuration data to create RTCPeerConnection,
 
@@ -121,111 +121,209 @@ of the web page.
 '''
 
 import sys, traceback, logging, re, json
+from collections import deque
 from ....std.ietf.rfc6455 import HTTPError, serve_forever as websocket_serve_forever
 
 
 logger = logging.getLogger('notify')
 configuration = {'iceServers': [{"url": "stun:stun.l.google.com:19302"}]}
 
+# the encoded messages are UTF-8 bytes, which send_message sends without encoding again.
+_loads, _dumps = json.loads, lambda obj: json.dumps(obj).encode('utf-8')
+
+# the response to GET /peerconnection is the same except for msg_id, so serialize it only once.
+# Hence, configuration must not be changed after this, since the change will not be in the response.
+_pc_prefix = b'{"code": "success", "result": {"configuration": ' + _dumps(configuration) + b'}'
+
+# a NOTIFY message from the client is forwarded without parsing its data, if it starts with _notify_head.
+# The common case of a flat data object, e.g., session description or candidate, or a scalar value,
+# is recognized by _notify_flat in one match that follows the JSON grammar, and any nested data
+# by a scan of _notify_tokens, and then validated.
+_notify_prefix, _notify_suffix = b'{"method":"NOTIFY","data":', b'}' # envelope of the forwarded data
+_ws = r'[ \t\n\r]*' # only these are whitespace in JSON, unlike \s
+_string = r'"[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*"'
+_scalar = _string + r'|-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?|true|false|null'
+_member = r'(?:%s)%s:%s(?:%s)%s' % (_string, _ws, _ws, _scalar, _ws)
+_notify_head = re.compile(r'\{%s"method"%s:%s"NOTIFY"%s,%s"data"%s:%s' % ((_ws,) * 7))
+_notify_flat = re.compile(_notify_head.pattern + r'(%s|\{%s(?:%s(?:,%s%s)*)?\})%s\}%s\Z' % (_scalar, _ws, _member, _ws, _member, _ws, _ws))
+_notify_tokens = re.compile(_string + r'|[{}\[\],]')
+
+
+def _notify_data(message):
+    '''Return the encoded data value of a NOTIFY message of the form {"method":"NOTIFY","data":...},
+    or None if the message is not of that form, e.g., has other attributes.
+    
+    >>> print(_notify_data('{"method":"NOTIFY","data":{"type":"offer","sdp":"v=0 }\\\\"}"}}'))
+    {"type":"offer","sdp":"v=0 }\\"}"}
+    >>> print(_notify_data('{"method": "NOTIFY", "data": null}'))
+    null
+    >>> print(_notify_data('{"method":"NOTIFY","data":{"candidate":"x"},"to":2}'))
+    None
+    >>> print(_notify_data('{"method":"NOTIFY","data":{"a":[1,{"b":"]"}]}}'))
+    {"a":[1,{"b":"]"}]}
+    >>> print(_notify_data('{"method":"NOTIFY","data":{"a":[1,{"b":}]}}'))
+    None
+    >>> print(_notify_data('{"method":"NOTIFY","data":[1 2]}'))
+    None
+    >>> print(_notify_data('{"method":"NOTIFY","data":1 2}'))
+    None
+    >>> print(_notify_data('{"method":"NOTIFY","data":{bad}}'))
+    None
+    >>> print(_notify_data('{"method":"NOTIFY","data":{"a":01}}'))
+    None
+    >>> print(_notify_data(u'{"method":"NOTIFY","data":{"a":1\\x0c}}'))
+    None
+    '''
+    match = _notify_flat.match(message)
+    if match: return match.group(1)
+    match = _notify_head.match(message)
+    if not match: return None
+    start, depth = match.end(), 0
+    for match in _notify_tokens.finditer(message, start): # strings are skipped as single tokens
+        token = match.group()
+        if token == '{' or token == '[': depth += 1
+        elif token == '}' or token == ']':
+            if depth == 0:
+                if message[match.end():].strip(' \t\n\r'): return None # only JSON whitespace may follow
+                payload = message[start:match.start()]
+                try: _loads(payload) # nested data is not checked by the scan, so validate it here
+                except ValueError: return None # let the caller parse the message, and fail
+                return payload
+            depth -= 1
+        elif token == ',' and depth == 0: return None # has other attributes after data
+    return None
+
 
 class Space(object):
+    __slots__ = ('path', 'a', 'b', 'pending') # at most two requests in slots a and b
+    
     def __init__(self, path):
-        self.path, self.requests, self.pending = path, [], []
+        self.path, self.a, self.b, self.pending = path, None, None, deque() # pending has (request, frame)
         logger.info('creating space %r', self.path)
     
     def __del__(self):
         logger.info('deleting space %r', self.path)
     
-    @property
-    def is_full(self):
-        return len(self.requests) >= 2
     
-    @property
-    def is_empty(self):
-        return len(self.requests) == 0
-    
-    
-    def add(self, request):
-        self.requests.append(request)
+    def add(self, request): # return False if the space is already full
+        if self.a is None: self.a = request
+        elif self.b is None: self.b = request
+        else: return False
+        return True
     
     def remove(self, request):
-        try: self.requests.remove(request)
-        except: pass # ignore if not found
-        self.pending[:] = [(r,d) for r,d in self.pending if r != request]
+        if self.a is request: self.a = None
+        elif self.b is request: self.b = None
+        if any(r is request for r,f in self.pending):
+            self.pending = deque((r,f) for r,f in self.pending if r is not request)
     
     def get_other(self, request):
-        result = [x for x in self.requests if x != request]
-        return result and result[0] or None
+        return self.b if request is self.a else self.a if request is self.b else None
     
     
 
-spaces = {} # table from path to Space object
+spaces = {} # table from path to Space object, where path is interned and stored in request.space_key
+_intern = getattr(sys, 'intern', None) or intern # builtin in Python 2
+_max_pending = 256 # maximum queued notifications in a space, before the other client connects
+_listen_re = re.compile(r'(tcp|tls):[a-z0-9_.\-]+:\d{1,5}\Z') # for --listen TYPE:HOST:PORT
 
 
 def onhandshake(request, path, headers):
-    if path in spaces:
-        space = spaces[path]
-        if space.is_full:
-            logger.error('space is full, closing')
-            raise HTTPError('400 Bad Request - Space Full')
+    space = spaces.get(path)
+    if space is not None and space.a is not None and space.b is not None: # space is full
+        logger.error('space is full, closing')
+        raise HTTPError('400 Bad Request - Space Full')
 
 
 def onopen(request):
-    if request.path in spaces:
-        space = spaces[request.path]
-    else:
-        space = spaces[request.path] = Space(request.path)
-        
-    space.add(request)
+    request.space_key = key = _intern(request.path)
+    request.overflow = False # set when the request queued too many notifications
+    space = spaces.get(key)
+    if space is None:
+        space = spaces[key] = Space(key)
+    
+    if not space.add(request): # another request got past onhandshake at the same time
+        logger.error('space is full, closing')
+        request.space_key = None # so that its messages are ignored
+        request.close(1008, 'space is full')
+        return
     
-    for ignore, data in space.pending:
-        request.send_message(json.dumps({'method': 'NOTIFY', 'data': data}))
-    space.pending[:] = []
+    if space.pending: # deliver all the queued notifications in one write
+        pending, space.pending = space.pending, deque() # detach first, so that no new item is lost
+        request.send_messages([frame for ignore, frame in pending])
 
 
 def onclose(request):
-    if request.path in spaces:
-        space = spaces[request.path]
+    space = spaces.get(request.space_key)
+    if space is not None:
         other = space.get_other(request)
         space.remove(request)
-        if other:
+        if other is not None:
             space.remove(other)
             other.close()
-        if space.is_empty:
-            del spaces[request.path]
+        if space.a is None and space.b is None: # space is empty
+            del spaces[request.space_key]
 
 
 def onmessage(request, message):
-    logger.debug("onmessage %r:\n%r", "%s:%d" % request.client_address, message)
-    data = json.loads(message)
+    '''Handle a received message, which is text, or bytes if it was received in a binary frame.
     
-    if data['method'] == 'GET' and data['resource'] == '/peerconnection':
-        response = {'code': 'success', 'result': {'configuration': configuration}}
-        if 'msg_id' in data:
-            response['msg_id'] = data['msg_id']
-        request.send_message(json.dumps(response))    
+    >>> class Request(object):
+    ...     space_key, overflow, client_address = '/test', False, ('127.0.0.1', 5000)
+    ...     def send_message(self, message): print(message == b'{"method":"NOTIFY","data":"\\xc3\\xa9"}')
+    >>> a, b = Request(), Request()
+    >>> spaces['/test'] = space = Space('/test'); space.add(a) and space.add(b)
+    True
+    >>> onmessage(a, b'{"method":"NOTIFY","data":"\\xc3\\xa9"}')
+    True
+    >>> onmessage(a, u'{"method":"NOTIFY","data":"\\xe9"}')
+    True
+    >>> del spaces['/test'], space
+    '''
+    if logger.isEnabledFor(logging.DEBUG): # avoid formatting the address when not logged
+        logger.debug("onmessage %r:\n%r", "%s:%d" % request.client_address, message)
+    payload = _notify_data(message) # common case of NOTIFY is dispatched without parsing
     
-    elif data['method'] == 'NOTIFY':
-        if request.path in spaces:
-            space = spaces[request.path]
-        else:
-            space = spaces[request.path] = Space(request.path)
+    if payload is not None:
+        if isinstance(payload, bytes): payload.decode('utf-8') # only check that binary data is UTF-8
+        else: payload = payload.encode('utf-8')
+    else:
+        data = _loads(message)
+        if data['method'] == 'GET' and data['resource'] == '/peerconnection':
+            if 'msg_id' in data:
+                request.send_message(_pc_prefix + b', "msg_id": ' + _dumps(data['msg_id']) + b'}')
+            else:
+                request.send_message(_pc_prefix + b'}')
+        elif data['method'] == 'NOTIFY':
+            payload = _dumps(data['data'])
+    
+    if payload is not None and request.space_key is not None:
+        space = spaces.get(request.space_key)
+        if space is None:
+            space = spaces[request.space_key] = Space(request.space_key)
         
-        other = space.get_other(request)
-        if other:
+        frame, other = _notify_prefix + payload + _notify_suffix, space.get_other(request)
+        if other is not None:
             try:
-                other.send_message(json.dumps({'method': 'NOTIFY', 'data': data['data']}))
+                other.send_message(frame)
             except:
                 pass # ignore if socket was closed.
+        elif len(space.pending) >= _max_pending:
+            if not request.overflow: # close only once, since onclose is called later
+                request.overflow = True
+                logger.warning('pending overflow on %r, closing', space.path)
+                request.close(1008, 'too many pending notifications') # instead of dropping any, e.g., offer
         else:
-            space.pending.append((request, data['data']))
+            space.pending.append((request, frame)) # the encoded frame is queued, to send as is later
         
 
 def serve_forever(options):
-    if not re.match('(tcp|tls):[a-z0-9_\-\.]+:\d{1,5}$', options.listen):
+    if not _listen_re.match(options.listen):
         raise RuntimeError('Invalid listen option %r'%(options.listen,))
         
     typ, host, port = options.listen.split(":", 2)
+    if not 0 < int(port) <= 65535:
+        raise RuntimeError('Invalid port in listen option %r'%(options.listen,))
     if typ == 'tls' and (not options.certfile or not options.keyfile):
         raise RuntimeError('Missing certfile or keyfile option')
     
@@ -266,7 +364,9 @@ if __name__ == "__main__":
     (options, args) = parser.parse_args()
 
     if options.test:
-        sys.exit() # no tests
+        import doctest
+        doctest.testmod()
+        sys.exit()
         
     logging.basicConfig(level=logging.CRITICAL if options.quiet else logging.DEBUG if options.verbose else logging.INFO, format='%(asctime)s.%(msecs)d %(name)s %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     
@@ -282,5 +382,5 @@ if __name__ == "__main__":
         serve_forever(options)
     except KeyboardInterrupt:
         logger.debug('interrupted, exiting')
-    except RuntimeError, e:
+    except RuntimeError as e:
         logger.error(str(e))
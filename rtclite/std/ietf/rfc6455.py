@@ -126,10 +126,20 @@ headers to append to default set of handshake headers.
 
 The send_message method on the WebSocketHandler (or the request object of callbacks) takes
 a message and an optional opcode of 1 or 2, for UTF-8 text or binary data, respectively.
+A text message that is already encoded as UTF-8 bytes is sent as is.
   
   request.send_message("some text") # some UTF-8 text
   request.send_message("\x01\x02\x03\x04", opcode=2) # some binary data
 
+The send_messages method similarly takes a list of messages, and sends them in separate frames
+but in a single write on the socket, e.g., to deliver several queued messages together.
+
+  request.send_messages(["first text", "second text"])
+
+The close method closes the connection, optionally with a status code and reason in the close frame.
+
+  request.close(1008, "policy violation")
+
     
 Client is implemented using the WebSocket class. Please see interactive_client function for
 an example of how the class is used. The WebSocket object is constructed by supplying a list
@@ -296,10 +306,10 @@ class WebSocketHandler(SocketServer.StreamRequestHandler):
                 if self._read_frame(data): break
         logger.info('closing connection from %r', self.client_address)
     
-    # close the connection
-    def close(self):
+    # close the connection, with an optional status code and reason in the close frame
+    def close(self, code=None, reason=''):
         try:
-            self.request.sendall(send_server_event(opcode=0x8))
+            self.request.sendall(send_server_event(opcode=0x8, message=struct.pack('>H', code) + reason[:123] if code else ''))
             self.request.shutdown(socket.SHUT_WR)
             # TODO: should close the socket after a brief timeout, instead of waiting for other end
         except: pass
@@ -340,9 +350,14 @@ class WebSocketHandler(SocketServer.StreamRequestHandler):
         if opcode != 1 and opcode != 2: raise RuntimeError('invalid opcode')
         self.request.sendall(send_server_event(opcode=opcode, message=message))
 
+    # send many messages, one per frame, in one write. The opcode argument is same as send_message.
+    def send_messages(self, messages, opcode=1):
+        if opcode != 1 and opcode != 2: raise RuntimeError('invalid opcode')
+        self.request.sendall(''.join([send_server_event(opcode=opcode, message=message) for message in messages]))
+
 def send_server_event(opcode, message=''):
-    if opcode == 0x8: return struct.pack('>BB', 0x88, 0)
-    if opcode == 1: message = message.encode('utf-8') # convert to binary
+    if opcode == 0x8: return struct.pack('>BB', 0x88, len(message)) + message # close, with optional code and reason
+    if opcode == 1 and not isinstance(message, bytes): message = message.encode('utf-8') # convert to binary
     length = len(message)
     logger.debug('sending %d bytes frame', length)
     